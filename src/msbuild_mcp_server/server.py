@@ -1,8 +1,12 @@
+import asyncio
+import functools
 import re
-import subprocess
 import sys
 import os
-import tempfile
+import threading
+import weakref
+import xml.etree.ElementTree as ET
+from collections import deque
 from fastmcp import FastMCP
 from vswhere import get_latest_path
 
@@ -11,6 +15,40 @@ if sys.platform == "win32":
 
 mcp = FastMCP("MSBuild MCP Server")
 
+# Number of trailing output lines kept per stream for the failure report.
+_OUTPUT_TAIL_LINES = 200
+
+# Per-line buffer limit for the subprocess pipes. Longer lines are truncated
+# to _TRUNCATED_LINE_BYTES by _drain rather than failing the build.
+_STREAM_LIMIT = 1024 * 1024
+_TRUNCATED_LINE_BYTES = 8 * 1024
+
+# Concurrent builds allowed; each build already parallelizes itself with /m.
+_BUILD_SEMAPHORE = asyncio.Semaphore(max(1, (os.cpu_count() or 1) // 4))
+
+# Builds of the same project share obj/ and bin/, so they are serialized. Each
+# lock lives only while a build holds or waits on it.
+_PROJECT_LOCKS = weakref.WeakValueDictionary()
+
+_VAR_RE = re.compile(r'%([^%]+)%')
+_ERROR_RE = re.compile(rb'error', re.IGNORECASE)
+_ERROR_CARRY_BYTES = len(b"error") - 1
+
+# Sentinel distinguishing "not computed yet" from a cached ``None`` result.
+_UNSET = object()
+_BUILD_ENV_CACHE = _UNSET
+_BUILD_ENV_LOCK = threading.Lock()
+
+# Files that can change the result of a NuGet restore, looked up in the
+# project directory and every parent directory.
+_RESTORE_INPUT_NAMES = (
+    "Directory.Build.props",
+    "Directory.Build.targets",
+    "Directory.Packages.props",
+    "nuget.config",
+    "NuGet.Config",
+)
+
 
 def _get_build_environment():
     """
@@ -20,7 +58,22 @@ def _get_build_environment():
     (PATH, TEMP, APPDATA, etc.), which causes MSBuild's .NET SDK resolution to
     fail or hang. This function reads the complete environment from the registry
     so that MSBuild can locate all required SDKs and tools.
+
+    The environment is computed once and cached for the lifetime of the server.
+    Callers must not mutate the returned dict.
     """
+    global _BUILD_ENV_CACHE
+
+    if _BUILD_ENV_CACHE is not _UNSET:
+        return _BUILD_ENV_CACHE
+
+    with _BUILD_ENV_LOCK:
+        if _BUILD_ENV_CACHE is _UNSET:
+            _BUILD_ENV_CACHE = _read_build_environment()
+        return _BUILD_ENV_CACHE
+
+
+def _read_build_environment():
     if sys.platform != "win32":
         return None
 
@@ -36,18 +89,17 @@ def _get_build_environment():
     for root_key, sub_key in registry_keys:
         try:
             with winreg.OpenKey(root_key, sub_key) as key:
-                i = 0
-                while True:
+                _, value_count, _ = winreg.QueryInfoKey(key)
+                for i in range(value_count):
                     try:
                         name, value, _ = winreg.EnumValue(key, i)
-                        i += 1
-                        if name.upper() == "PATH":
-                            existing = env.get("PATH", "")
-                            env["PATH"] = (existing + ";" + value) if existing else value
-                        else:
-                            env[name] = value
                     except OSError:
                         break
+                    if name.upper() == "PATH":
+                        existing = env.get("PATH", "")
+                        env["PATH"] = (existing + ";" + value) if existing else value
+                    else:
+                        env[name] = value
         except OSError:
             continue
 
@@ -57,17 +109,17 @@ def _get_build_environment():
     result = os.environ.copy()
     result.update(env)
 
-    def _expand(value, env_dict):
-        upper_dict = {k.upper(): v for k, v in env_dict.items()}
+    for _ in range(3):
+        upper_dict = {k.upper(): v for k, v in result.items()}
 
         def _replace(m):
             var_name = m.group(1).upper()
             return upper_dict.get(var_name, m.group(0))
 
-        return re.sub(r'%([^%]+)%', _replace, value)
-
-    for _ in range(3):
-        expanded = {k: _expand(v, result) for k, v in result.items()}
+        expanded = {
+            k: (_VAR_RE.sub(_replace, v) if '%' in v else v)
+            for k, v in result.items()
+        }
         if expanded == result:
             break
         result = expanded
@@ -75,11 +127,21 @@ def _get_build_environment():
     return result
 
 
+@functools.lru_cache(maxsize=None)
 def find_msbuild():
     """
     Use the vswhere Python package to locate the MSBuild executable.
     Returns the path to MSBuild if found, otherwise raises an exception.
+
+    The MSBUILD_PATH environment variable, when set, overrides the lookup.
+    The result is cached for the lifetime of the server process.
     """
+    override = os.environ.get("MSBUILD_PATH")
+    if override:
+        if not os.path.exists(override):
+            raise FileNotFoundError(f"MSBuild executable not found at MSBUILD_PATH: {override}")
+        return override
+
     msbuild_installation_path = get_latest_path(products='*')
     if not msbuild_installation_path:
         raise FileNotFoundError("MSBuild executable not found. Ensure Visual Studio is installed.")
@@ -91,14 +153,159 @@ def find_msbuild():
     return msbuild_path
 
 
+def _local_name(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def _check_imports(root, path):
+    """Raise ValueError if an MSBuild file imports anything other than an SDK."""
+    for element in root.iter():
+        if _local_name(element) == "Import" and not element.get("Sdk"):
+            raise ValueError(f"Cannot track Import {element.get('Project')!r} in {path}")
+
+
+def _restore_inputs(project_path, seen):
+    """
+    Yield the files whose changes can invalidate ``project_path``'s restore.
+
+    These are the project file, its ``packages.config``, the files named in
+    ``_RESTORE_INPUT_NAMES`` from the project directory up to the root, and the
+    same inputs for every project reached through ``ProjectReference`` items.
+    Raises ValueError for references that cannot be resolved statically, for
+    referenced projects that have not been restored, and for non-SDK imports,
+    whose targets are not followed.
+    """
+    project_path = os.path.normcase(os.path.abspath(project_path))
+    if project_path in seen:
+        return
+    seen.add(project_path)
+
+    project_dir = os.path.dirname(project_path)
+    yield project_path
+    yield os.path.join(project_dir, "packages.config")
+
+    directory = project_dir
+    while True:
+        for name in _RESTORE_INPUT_NAMES:
+            path = os.path.join(directory, name)
+            if name.startswith("Directory.") and os.path.isfile(path):
+                _check_imports(ET.parse(path).getroot(), path)
+            yield path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+    root = ET.parse(project_path).getroot()
+    _check_imports(root, project_path)
+    for element in root.iter():
+        if _local_name(element) != "ProjectReference":
+            continue
+        include = element.get("Include", "")
+        if not include or "$(" in include or "*" in include:
+            raise ValueError(f"Cannot resolve ProjectReference: {include!r}")
+        reference = os.path.join(project_dir, include.replace("\\", os.sep))
+        reference_assets = os.path.join(os.path.dirname(reference), "obj", "project.assets.json")
+        if not os.path.isfile(reference_assets):
+            raise ValueError(f"ProjectReference has not been restored: {include!r}")
+        yield from _restore_inputs(reference, seen)
+
+
+def _needs_restore(project_path):
+    """
+    Return whether NuGet restore is needed for the project.
+
+    Restore is skipped only when ``obj/project.assets.json`` next to the project
+    is newer than every file yielded by ``_restore_inputs``. Solutions, projects
+    without an assets file, projects with non-SDK imports and projects whose
+    references cannot be resolved or are unrestored always restore. Floating
+    package versions are not detected.
+    """
+    project_dir = os.path.dirname(os.path.abspath(project_path))
+    try:
+        assets_mtime = os.stat(os.path.join(project_dir, "obj", "project.assets.json")).st_mtime
+    except OSError:
+        return True
+
+    try:
+        inputs = list(_restore_inputs(project_path, set()))
+    except (OSError, ET.ParseError, ValueError):
+        return True
+
+    for path in inputs:
+        try:
+            if os.stat(path).st_mtime > assets_mtime:
+                return True
+        except OSError:
+            continue
+
+    return False
+
+
+async def _drain(stream, tail, error_lines):
+    """
+    Read a subprocess pipe line by line until EOF.
+
+    Every line is pushed into the bounded ``tail`` deque, and lines mentioning
+    "error" are collected into ``error_lines`` as they arrive, so the full log
+    is never held in memory. Lines longer than the stream limit are truncated
+    to their first ``_TRUNCATED_LINE_BYTES`` bytes, but are still matched
+    against ``_ERROR_RE`` in full.
+    """
+    head = None
+    head_matched = False
+    # Trailing bytes of the last discarded chunk, so a match split across
+    # chunks is still found.
+    carry = b""
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+            at_eof = False
+        except asyncio.LimitOverrunError as e:
+            # The data is left in the buffer; consume it and keep only the head.
+            chunk = await stream.read(e.consumed)
+            if head is None:
+                head = chunk[:_TRUNCATED_LINE_BYTES]
+            if not head_matched and _ERROR_RE.search(carry + chunk):
+                head_matched = True
+            carry = chunk[-_ERROR_CARRY_BYTES:]
+            continue
+        except asyncio.IncompleteReadError as e:
+            line = e.partial
+            at_eof = True
+
+        line = line.rstrip(b"\r\n")
+        if head is not None:
+            matched = head_matched or bool(_ERROR_RE.search(carry + line))
+            line = head + b" [truncated]"
+            head, head_matched, carry = None, False, b""
+        else:
+            matched = bool(_ERROR_RE.search(line))
+
+        if line or not at_eof:
+            tail.append(line)
+            if matched:
+                error_lines.append(line)
+
+        if at_eof:
+            break
+
+
+def _decode_lines(lines):
+    return "\n".join(line.decode("utf-8", errors="replace") for line in lines)
+
+
 @mcp.tool()
-def build_msbuild_project(
+async def build_msbuild_project(
     project_path: str,
     configuration: str = "Debug",
     platform: str = "x64",
     verbosity: str = "minimal",
     max_cpu_count: int = None,
     restore: bool = False,
+    skip_up_to_date_restore: bool = False,
+    cl_mp: int = None,
+    binary_log_path: str = "",
     additional_args: str = ""
 ) -> str:
     """
@@ -114,6 +321,17 @@ def build_msbuild_project(
     - verbosity: MSBuild output verbosity (quiet, minimal, normal, detailed, diagnostic).
     - max_cpu_count: Maximum number of CPUs for parallel build (None for default).
     - restore: Whether to perform NuGet restore before build.
+    - skip_up_to_date_restore: With restore, skip it when obj/project.assets.json is newer than
+      the project, its packages.config, any Directory.Build.props/.targets, Directory.Packages.props
+      or nuget.config above it, and the same files for referenced projects. Projects with
+      non-SDK <Import>s or unrestored references always restore. Floating package versions
+      are not detected, so leave this off when using them. NuGet's own no-op check
+      still applies when restore runs.
+    - cl_mp: Number of source files cl.exe may compile in parallel within a C++ project with /MP
+      enabled (None to leave it to the project). When set, the MSBuild node count is reduced to
+      match unless max_cpu_count is given.
+    - binary_log_path: Write an MSBuild binary log (.binlog) to this path for detailed
+      diagnosis, instead of rebuilding with a higher verbosity.
     - additional_args: Additional MSBuild command-line arguments.
 
     Returns:
@@ -121,7 +339,11 @@ def build_msbuild_project(
 
     Use this tool to automate the build process for MSBuild projects, ensuring compatibility with various configurations and environments.
     """
-    msbuild = find_msbuild()
+    if cl_mp is not None and cl_mp < 1:
+        return f"Invalid cl_mp: {cl_mp}. It must be a positive number of parallel compilations."
+
+    # The first lookup spawns vswhere; keep it off the event loop.
+    msbuild = await asyncio.to_thread(find_msbuild)
     cmd = [
         msbuild,
         project_path,
@@ -130,65 +352,110 @@ def build_msbuild_project(
         f"/verbosity:{verbosity}",
     ]
 
+    cpu_count = os.cpu_count() or 1
     if max_cpu_count:
         cmd.append(f"/maxcpucount:{max_cpu_count}")
+    elif cl_mp:
+        # Each project node may run cl_mp compilers, so scale the node count
+        # down to keep the total number of cl.exe processes near the CPU count.
+        cmd.append(f"/maxcpucount:{max(1, cpu_count // cl_mp)}")
     else:
         cmd.append("/m")
 
+    if cl_mp:
+        cmd.append(f"/p:CL_MPCount={cl_mp}")
+
     cmd.append("/nodeReuse:false")
 
-    if restore:
+    if restore and (
+        not skip_up_to_date_restore
+        or await asyncio.to_thread(_needs_restore, project_path)
+    ):
         cmd.append("/restore")
 
+    if binary_log_path:
+        cmd.append(f"/bl:{binary_log_path}")
+
     if additional_args:
         cmd.extend(additional_args.split())
 
-    build_env = _get_build_environment()
-
-    stdout_file = tempfile.NamedTemporaryFile(
-        mode='w+', suffix='_msbuild_stdout.txt', delete=False, encoding='utf-8'
-    )
-    stderr_file = tempfile.NamedTemporaryFile(
-        mode='w+', suffix='_msbuild_stderr.txt', delete=False, encoding='utf-8'
-    )
+    # Also disable node reuse via the environment so child MSBuild processes
+    # (e.g. those spawned by <MSBuild> tasks or wrapper scripts) don't leave
+    # worker nodes running after the tool call returns.
+    build_env = {
+        **(await asyncio.to_thread(_get_build_environment) or os.environ),
+        "MSBUILDDISABLENODEREUSE": "1",
+    }
+
+    stdout_tail = deque(maxlen=_OUTPUT_TAIL_LINES)
+    stderr_tail = deque(maxlen=_OUTPUT_TAIL_LINES)
+    error_lines_stdout = []
+    error_lines_stderr = []
+
+    project_key = os.path.normcase(os.path.abspath(project_path))
+    project_lock = _PROJECT_LOCKS.get(project_key)
+    if project_lock is None:
+        project_lock = _PROJECT_LOCKS[project_key] = asyncio.Lock()
+
+    # Take the project lock first so a queued duplicate doesn't hold a build slot.
+    async with project_lock, _BUILD_SEMAPHORE:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=build_env,
+                limit=_STREAM_LIMIT,
+            )
+        except FileNotFoundError:
+            return "MSBuild executable not found. Ensure MSBuild is installed and added to the PATH."
 
-    try:
-        proc = subprocess.Popen(
-            cmd,
-            stdin=subprocess.DEVNULL,
-            stdout=stdout_file,
-            stderr=stderr_file,
-            env=build_env,
+        try:
+            await asyncio.gather(
+                _drain(proc.stdout, stdout_tail, error_lines_stdout),
+                _drain(proc.stderr, stderr_tail, error_lines_stderr),
+            )
+            await proc.wait()
+        except BaseException:
+            # Don't leave MSBuild running (and blocked on a full pipe) when the
+            # tool call is cancelled or reading the output fails.
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            raise
+
+    if proc.returncode == 0:
+        return f"Build succeeded."
+    else:
+        binary_log = f"\nBinary Log:\n{binary_log_path}" if binary_log_path else ""
+        error_lines = error_lines_stdout + error_lines_stderr
+        if error_lines:
+            filtered_errors = _decode_lines(error_lines)
+            return f"Build failed with errors.\nFiltered Errors:\n{filtered_errors}{binary_log}"
+
+        # Nothing matched the error filter, so fall back to the output tail.
+        stdout = _decode_lines(stdout_tail)
+        stderr = _decode_lines(stderr_tail)
+        return (
+            f"Build failed with errors.\nOutput (last {_OUTPUT_TAIL_LINES} lines):\n{stdout}"
+            f"\nErrors (last {_OUTPUT_TAIL_LINES} lines):\n{stderr}{binary_log}"
         )
 
-        proc.wait()
-        stdout_file.close()
-        stderr_file.close()
-
-        with open(stdout_file.name, 'r', encoding='utf-8', errors='replace') as f:
-            stdout = f.read()
-        with open(stderr_file.name, 'r', encoding='utf-8', errors='replace') as f:
-            stderr = f.read()
 
-        if proc.returncode == 0:
-            return f"Build succeeded."
-        else:
-            error_lines_stdout = [line for line in stdout.splitlines() if "error" in line.lower()]
-            error_lines_stderr = [line for line in stderr.splitlines() if "error" in line.lower()]
-            filtered_errors = "\n".join(error_lines_stdout + error_lines_stderr)
-            return f"Build failed with errors.\nFiltered Errors:\n{filtered_errors}\nFull Output:\n{stdout}\nErrors:\n{stderr}"
+def _prewarm():
+    """Resolve MSBuild and the build environment ahead of the first tool call."""
+    _get_build_environment()
+    try:
+        find_msbuild()
     except FileNotFoundError:
-        return "MSBuild executable not found. Ensure MSBuild is installed and added to the PATH."
-    finally:
-        for path in [stdout_file.name, stderr_file.name]:
-            try:
-                os.unlink(path)
-            except OSError:
-                pass
+        # Not cached; the build tool will retry and report the error.
+        pass
 
 
 def main():
     """Entry point for the msbuild-mcp-server CLI."""
+    threading.Thread(target=_prewarm, daemon=True).start()
     mcp.run()
 
 
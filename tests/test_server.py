@@ -0,0 +1,278 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from msbuild_mcp_server import server
+
+posix_only = pytest.mark.skipif(sys.platform == "win32", reason="uses a POSIX shell script as MSBuild")
+
+
+async def _drain_chunks(chunks, limit=2 ** 16):
+    reader = asyncio.StreamReader(limit=limit)
+    tail, errors = [], []
+    task = asyncio.create_task(server._drain(reader, tail, errors))
+    for chunk in chunks:
+        reader.feed_data(chunk)
+        for _ in range(5):
+            await asyncio.sleep(0)
+    reader.feed_eof()
+    await task
+    return list(tail), errors
+
+
+def drain(chunks, limit=2 ** 16):
+    return asyncio.run(_drain_chunks(chunks, limit))
+
+
+@pytest.fixture
+def fake_msbuild(tmp_path, monkeypatch):
+    """Install a shell script as MSBuild and return a function setting its body."""
+    script = tmp_path / "msbuild.sh"
+
+    def install(body):
+        script.write_text("#!/bin/sh\n" + body + "\n")
+        script.chmod(0o755)
+        return script
+
+    install("exit 0")
+    monkeypatch.setenv("MSBUILD_PATH", str(script))
+    server.find_msbuild.cache_clear()
+    yield install
+    server.find_msbuild.cache_clear()
+
+
+def test_drain_strips_line_endings_and_keeps_partial_last_line():
+    tail, errors = drain([b"one\r\ntwo\n", b"\nthr", b"ee"])
+    assert tail == [b"one", b"two", b"", b"three"]
+    assert errors == []
+
+
+def test_drain_collects_error_lines_case_insensitively():
+    tail, errors = drain([b"ok\nfoo.cpp(3): ERROR C2065\nwarning\nBuild Error.\n"])
+    assert errors == [b"foo.cpp(3): ERROR C2065", b"Build Error."]
+    assert len(tail) == 4
+
+
+def test_drain_truncates_overlong_lines_and_keeps_reading(monkeypatch):
+    monkeypatch.setattr(server, "_TRUNCATED_LINE_BYTES", 8)
+    tail, errors = drain([b"x" * 40 + b"\nnext line\n"], limit=16)
+    assert tail == [b"x" * 8 + b" [truncated]", b"next line"]
+    assert errors == []
+
+
+def test_drain_finds_errors_past_the_truncated_head(monkeypatch):
+    monkeypatch.setattr(server, "_TRUNCATED_LINE_BYTES", 8)
+    tail, errors = drain([b"x" * 40, b"y" * 40 + b" error here\n", b"after\n"], limit=16)
+    assert errors == [b"x" * 8 + b" [truncated]"]
+    assert tail[-1] == b"after"
+
+
+def test_drain_finds_errors_split_across_discarded_chunks(monkeypatch):
+    monkeypatch.setattr(server, "_TRUNCATED_LINE_BYTES", 8)
+    tail, errors = drain([b"x" * 20 + b"er", b"ror" + b"y" * 20 + b"\n"], limit=16)
+    assert errors == [b"x" * 8 + b" [truncated]"]
+
+
+def test_drain_truncates_overlong_final_line_without_newline(monkeypatch):
+    monkeypatch.setattr(server, "_TRUNCATED_LINE_BYTES", 8)
+    tail, errors = drain([b"z" * 40], limit=16)
+    assert tail == [b"z" * 8 + b" [truncated]"]
+
+
+@posix_only
+def test_build_reports_filtered_errors(fake_msbuild):
+    fake_msbuild('echo "line"; echo "a.cpp(1): error C1"; echo "stderr error" >&2; exit 1')
+    result = asyncio.run(server.build_msbuild_project("app.csproj"))
+    assert result == "Build failed with errors.\nFiltered Errors:\na.cpp(1): error C1\nstderr error"
+
+
+@posix_only
+def test_build_reports_output_tail_when_nothing_matches(fake_msbuild):
+    fake_msbuild('echo "something went wrong"; exit 1')
+    result = asyncio.run(server.build_msbuild_project("app.csproj"))
+    assert f"Output (last {server._OUTPUT_TAIL_LINES} lines):\nsomething went wrong" in result
+
+
+@posix_only
+def test_build_succeeds(fake_msbuild):
+    assert asyncio.run(server.build_msbuild_project("app.csproj")) == "Build succeeded."
+
+
+@posix_only
+def test_cancelled_build_kills_msbuild(fake_msbuild, tmp_path):
+    pid_file = tmp_path / "pid"
+    fake_msbuild(f'echo $$ > "{pid_file}"; exec sleep 30')
+
+    async def run():
+        task = asyncio.create_task(server.build_msbuild_project("app.csproj"))
+        while not pid_file.exists() or not pid_file.read_text().strip():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+SDK_PROJECT = '<Project Sdk="Microsoft.NET.Sdk">{}</Project>'
+
+
+def _reference(include):
+    return f'<ItemGroup><ProjectReference Include="{include}" /></ItemGroup>'
+
+
+def _write(path, text, mtime=1000):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def _restored(project_dir, mtime=2000):
+    return _write(project_dir / "obj" / "project.assets.json", "{}", mtime)
+
+
+@pytest.fixture
+def app(tmp_path):
+    project = _write(tmp_path / "App" / "App.csproj", SDK_PROJECT.format(""))
+    _restored(project.parent)
+    return project
+
+
+def test_needs_restore_false_when_assets_are_newer(app):
+    assert not server._needs_restore(str(app))
+
+
+def test_needs_restore_without_assets(tmp_path):
+    project = _write(tmp_path / "App.csproj", SDK_PROJECT.format(""))
+    assert server._needs_restore(str(project))
+
+
+def test_needs_restore_when_project_changed(app):
+    os.utime(app, (3000, 3000))
+    assert server._needs_restore(str(app))
+
+
+@pytest.mark.parametrize("name", ["Directory.Build.props", "Directory.Build.targets",
+                                  "Directory.Packages.props", "nuget.config", "packages.config"])
+def test_needs_restore_when_restore_input_changed(app, name):
+    directory = app.parent if name == "packages.config" else app.parent.parent
+    _write(directory / name, "<Project />", mtime=3000)
+    assert server._needs_restore(str(app))
+
+
+def test_needs_restore_for_non_sdk_import(app):
+    _write(app, SDK_PROJECT.format('<Import Project="deps.props" />'))
+    _write(app.parent / "deps.props", "<Project />")
+    assert server._needs_restore(str(app))
+
+
+def test_needs_restore_for_non_sdk_import_in_directory_build_props(app):
+    _write(app.parent.parent / "Directory.Build.props", '<Project><Import Project="x.props" /></Project>')
+    assert server._needs_restore(str(app))
+
+
+def test_sdk_import_does_not_force_restore(app):
+    _write(app, SDK_PROJECT.format('<Import Project="Sdk.props" Sdk="Microsoft.NET.Sdk" />'))
+    assert not server._needs_restore(str(app))
+
+
+def test_needs_restore_when_reference_changed(tmp_path, app):
+    _write(app, SDK_PROJECT.format(_reference(r"..\Lib\Lib.csproj")))
+    lib = _write(tmp_path / "Lib" / "Lib.csproj", SDK_PROJECT.format(""), mtime=3000)
+    _restored(lib.parent)
+    assert server._needs_restore(str(app))
+
+
+def test_needs_restore_when_reference_is_unrestored(tmp_path, app):
+    _write(app, SDK_PROJECT.format(_reference(r"..\Lib\Lib.csproj")))
+    _write(tmp_path / "Lib" / "Lib.csproj", SDK_PROJECT.format(""))
+    assert server._needs_restore(str(app))
+
+
+def test_needs_restore_for_unresolvable_reference(app):
+    _write(app, SDK_PROJECT.format(_reference(r"$(Root)\Lib\Lib.csproj")))
+    assert server._needs_restore(str(app))
+
+
+def test_reference_cycle_terminates(tmp_path, app):
+    _write(app, SDK_PROJECT.format(_reference(r"..\Lib\Lib.csproj")))
+    lib = _write(tmp_path / "Lib" / "Lib.csproj", SDK_PROJECT.format(_reference(r"..\App\App.csproj")))
+    _restored(lib.parent)
+    assert not server._needs_restore(str(app))
+    inputs = list(server._restore_inputs(str(app), set()))
+    assert inputs.count(os.path.normcase(str(lib))) == 1
+
+
+@posix_only
+def test_build_skips_up_to_date_restore_only_when_asked(fake_msbuild, tmp_path, app):
+    args_file = tmp_path / "args"
+    fake_msbuild(f'printf "%s\\n" "$@" > "{args_file}"')
+
+    asyncio.run(server.build_msbuild_project(str(app), restore=True))
+    assert "/restore" in args_file.read_text().splitlines()
+
+    asyncio.run(server.build_msbuild_project(str(app), restore=True, skip_up_to_date_restore=True))
+    assert "/restore" not in args_file.read_text().splitlines()
+
+
+@pytest.fixture
+def build_args(fake_msbuild, tmp_path, monkeypatch):
+    """Run a stub build on an 8-CPU machine and return the MSBuild arguments."""
+    args_file = tmp_path / "args"
+    fake_msbuild(f'printf "%s\\n" "$@" > "{args_file}"')
+    monkeypatch.setattr(server.os, "cpu_count", lambda: 8)
+
+    def run(project_path="app.vcxproj", **kwargs):
+        assert asyncio.run(server.build_msbuild_project(project_path, **kwargs)) == "Build succeeded."
+        return args_file.read_text().splitlines()
+
+    return run
+
+
+@posix_only
+def test_vcxproj_without_cl_mp_keeps_default_parallelism(build_args):
+    args = build_args()
+    assert "/m" in args
+    assert not [arg for arg in args if arg.startswith("/p:CL_MPCount")]
+
+
+@posix_only
+@pytest.mark.parametrize("cl_mp, max_cpu_count", [(4, "2"), (3, "2"), (16, "1")])
+def test_cl_mp_scales_node_count(build_args, cl_mp, max_cpu_count):
+    args = build_args(cl_mp=cl_mp)
+    assert f"/maxcpucount:{max_cpu_count}" in args
+    assert f"/p:CL_MPCount={cl_mp}" in args
+
+
+@posix_only
+def test_explicit_max_cpu_count_wins_over_cl_mp(build_args):
+    args = build_args(cl_mp=4, max_cpu_count=3)
+    assert "/maxcpucount:3" in args
+    assert "/p:CL_MPCount=4" in args
+
+
+@pytest.mark.parametrize("cl_mp", [0, -2])
+def test_invalid_cl_mp_is_rejected(cl_mp):
+    result = asyncio.run(server.build_msbuild_project("app.vcxproj", cl_mp=cl_mp))
+    assert result.startswith(f"Invalid cl_mp: {cl_mp}.")
+
+
+@posix_only
+def test_builds_of_the_same_project_are_serialized(fake_msbuild, tmp_path):
+    log = tmp_path / "log"
+    fake_msbuild(f'echo start >> "{log}"; sleep 0.2; echo end >> "{log}"')
+
+    async def run():
+        await asyncio.gather(
+            server.build_msbuild_project("app.csproj"),
+            server.build_msbuild_project("./app.csproj"),
+        )
+
+    asyncio.run(run())
+    assert log.read_text().split() == ["start", "end", "start", "end"]
+    assert len(server._PROJECT_LOCKS) == 0